@@ -29,32 +29,54 @@ import threading
 import time
 import io
 import re
+import shutil
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from functools import wraps
+from operator import methodcaller
 from pathlib import Path
-from xml.etree import cElementTree as ElementTree
-from datetime import timedelta, tzinfo
+from requests.adapters import HTTPAdapter
+from datetime import datetime, timedelta, tzinfo
 from optparse import OptionParser
 sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding="utf-8",
                               errors='replace')
 
 NAME = 'enhance'
 VERSION = '0.0.2'
-TIME_FORMAT = '%Y%m%d%H%M%S'
 threadcount = multiprocessing.cpu_count() * 2
 log = logging.getLogger(NAME)
 logging.basicConfig(level=logging.WARNING, format='%(message)s')
 downloadlist = []
+dirs_made = set()
+posters_seen = set()
+posters_lock = threading.Lock()
+redis_cache = {}
+redis_preloaded = False
+stored_keys = set()
+stored_lock = threading.Lock()
+tmdb_images_url = None
+tmdb_images_lock = threading.Lock()
 
 # Variables
 REDIS_HOST = os.getenv('REDIS_HOST', "localhost")
 REDIS_PORT = os.getenv('REDIS_PORT', 6379)
 REDIS_PASS = os.getenv('REDIS_PASS', "")
 TMDB_API = os.getenv('TMDB_API', None)
+REDIS_EXPIRE = 60 * 60 * 24 * 90
 
 
 r = redis.Redis(
     host=REDIS_HOST,
-    port=REDIS_PORT,
-    password=REDIS_PASS)
+    port=int(REDIS_PORT),
+    password=REDIS_PASS,
+    decode_responses=True)
+
+# all artwork downloads share keep-alive connections and a worker pool
+session = requests.Session()
+adapter = HTTPAdapter(pool_connections=16, pool_maxsize=threadcount,
+                      max_retries=2)
+session.mount('http://', adapter)
+session.mount('https://', adapter)
+download_pool = ThreadPoolExecutor(max_workers=threadcount)
 
 try:
     import tmdbv3api
@@ -64,6 +86,16 @@ except ImportError:
 else:
     tmdbcheck = True
 
+try:
+    from lxml import etree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+    lxmlcheck = False
+    find_programmes = methodcaller('findall', './/programme')
+else:
+    lxmlcheck = True
+    find_programmes = ElementTree.XPath('.//programme')
+
 
 class UTC(tzinfo):
     """
@@ -93,6 +125,8 @@ class LocalTimezone(tzinfo):
             self.DSTOFFSET = self.STDOFFSET
 
         self.DSTDIFF = self.DSTOFFSET - self.STDOFFSET
+        # DST only changes on the hour, remember the answer per hour
+        self._dst_cache = {}
         tzinfo.__init__(self)
 
     def utcoffset(self, dt):
@@ -111,11 +145,15 @@ class LocalTimezone(tzinfo):
         return time.tzname[self._isdst(dt)]
 
     def _isdst(self, dt):
-        tt = (dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second,
-              dt.weekday(), 0, -1)
-        stamp = time.mktime(tt)
-        tt = time.localtime(stamp)
-        return tt.tm_isdst > 0
+        key = (dt.year, dt.month, dt.day, dt.hour)
+        isdst = self._dst_cache.get(key)
+        if isdst is None:
+            tt = (dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second,
+                  dt.weekday(), 0, -1)
+            stamp = time.mktime(tt)
+            tt = time.localtime(stamp)
+            isdst = self._dst_cache[key] = tt.tm_isdst > 0
+        return isdst
 
 
 localtz = LocalTimezone()
@@ -124,10 +162,34 @@ utc = UTC()
 
 class BaseProcessor(object):
     valid = True
+    # lookups are slow network calls, run them in a thread pool first
+    threaded = False
+    # lookup() results from the thread pool, by programme
+    prefetched = None
 
-    def __call__(self, programme):
+    def __call__(self, programme, kids):
+        """
+        Modify the programme. kids is its children() map, shared by every
+        processor, so keep it current when adding or replacing children.
+        """
         raise NotImplementedError
 
+    def lookup(self, programme):
+        """
+        Fetch what the processor needs for a programme from Redis/TMDB.
+        Called from worker threads so it must not modify the programme.
+        """
+        raise NotImplementedError
+
+    def found(self, programme):
+        """
+        The lookup() result for a programme, taken from prefetch() when it
+        ran, otherwise looked up now. A failed prefetch gives None.
+        """
+        if self.prefetched is not None:
+            return self.prefetched.pop(programme, None)
+        return self.lookup(programme)
+
     def post_process(self, programmes):
         raise NotImplementedError
 
@@ -136,6 +198,7 @@ class Movies(BaseProcessor):
     """
     Augment movies with data from themoviedb.com
     """
+    threaded = True
 
     def __init__(self):
         if not tmdbcheck:
@@ -153,7 +216,7 @@ class Movies(BaseProcessor):
         tmdb.api_key = TMDB_API
         tmdb.language = 'en'
 
-    def __call__(self, programme):
+    def lookup(self, programme):
         if not self.valid:
             return
 
@@ -167,15 +230,7 @@ class Movies(BaseProcessor):
         #    return
         if stop is None:
             return
-        # Unfortunately strptime can't handle numeric timezones so we strip it.
-        # It's only for getting possible movies so won't matter too much.
-        if ' ' in start:
-            start = start.split(' ')[0]
-        if ' ' in stop:
-            stop = stop.split(' ')[0]
-        start_time = time.mktime(time.strptime(start, TIME_FORMAT))
-        stop_time = time.mktime(time.strptime(stop, TIME_FORMAT))
-        duration = stop_time - start_time
+        duration = programme_duration(start, stop)
         # always look up things in the movie category. try to identify others
         # by duration/channel/title
         MovieCat = False
@@ -190,17 +245,19 @@ class Movies(BaseProcessor):
         log.debug('Movies: Possible movie "%s" (duration %dm) on channel "%s"',
                   title, duration / 60, channel)
 
-        movie = None
         movie_title = None
         movie_runtime = None
         movie_posterurl = None
         movie_overview = None
         movie_genres = None
-        genres_list = None
 
-        if r.get('movies.{}.title'.format(title.replace(" ", "_"))):
-            movie_title = r.get('movies.{}.title'.format(title.replace(" ",
-                                "_"))).decode('utf-8')
+        # everything cached for a title lives in one hash
+        key = 'movies:' + title.replace(" ", "_")
+        query = title.replace('?', '')
+        cached = cache_fetch(key)
+
+        if cached:
+            movie_title = cached.get('title')
             if movie_title == "NotFound":
                 log.debug('Movies: Ignored "%s" due to being set to NotFound '
                           'on tmdb', title)
@@ -210,95 +267,62 @@ class Movies(BaseProcessor):
                           'tmdb', title)
                 return
             else:
-                movie_runtime = r.get('movies.{}.runtime'.format(
-                                      title.replace(" ", "_"))).decode('utf-8')
-                if r.get('movies.{}.poster'.format(title.replace(" ", "_"))):
-                    movie_posterurl = r.get('movies.{}.poster'.format(
-                                            title.replace(" ", "_"))
-                                            ).decode('utf-8')
-                movie_overview = r.get('movies.{}.overview'.format(
-                                       title.replace(" ", "_"))
-                                       ).decode('utf-8')
-                if r.get('movies.{}.genres'.format(title.replace(" ", "_"))):
-                    movie_genres = r.get('movies.{}.genres'.format(
-                        title.replace(" ", "_"))).decode('utf-8')
+                movie_runtime = cached.get('runtime') or None
+                movie_posterurl = cached.get('poster') or None
+                movie_overview = cached.get('overview') or None
+                movie_genres = cached.get('genres') or None
                 log.debug('Movies: Redis hit for "%s"', title)
         else:
             try:
-                movietmdb = tmdbv3api.Movie()
-                results = movietmdb.search(title.replace('?', ''))
+                results = search_movies(query)
             except tmdbv3api.tmdb.TMDbException:
                 log.exception('Movies: TMDB problem searching')
                 return
             matches = []
+            norm_title = normalise_title(title)
             for result in results:
                 if result is not None:
-                    if normalise_title(title) == normalise_title(result.title):
+                    if norm_title == normalise_title(result.title):
                         matches.append(result)
             log.debug('Movies: Exact title matches: %d', len(matches))
-            for movie in matches:
-                try:
-                    moviedetails = movietmdb.details(movie.id)
-                except tmdbv3api.tmdb.TMDbException:
-                    log.exception('Movies: TMDB problem fetching info')
-                    return
-                if moviedetails.release_date is None:
-                    log.debug('Movies: Found match "%s"', moviedetails.title)
-                else:
-                    log.debug('Movies: Found match "%s" (%s)', moviedetails.title, moviedetails.release_date)
+            # only worth the extra requests when someone is reading them
+            if log.isEnabledFor(logging.DEBUG):
+                for movie in matches:
+                    try:
+                        moviedetails = movie_details(movie.id)
+                    except tmdbv3api.tmdb.TMDbException:
+                        log.exception('Movies: TMDB problem fetching info')
+                        return
+                    if moviedetails.release_date is None:
+                        log.debug('Movies: Found match "%s"', moviedetails.title)
+                    else:
+                        log.debug('Movies: Found match "%s" (%s)', moviedetails.title, moviedetails.release_date)
             if len(matches) == 1:
                 try:
                     log.debug('Movies: Cache miss for "%s"', title)
-                    movie = movietmdb.details(matches[0].id)
+                    movie = movie_details(matches[0].id)
                 except tmdbv3api.tmdb.TMDbException:
                     log.exception('Movies: TMDB problem fetching info')
                     return
                 movie_title = movie.title
                 movie_runtime = movie.runtime
                 if movie.poster_path is not None:
-                    tmdbconfiguration = tmdbv3api.Configuration()
-                    base_url = tmdbconfiguration.info().images['base_url']
-                    movie_posterurl = base_url + "w342" + movie.poster_path
-                    r.set('movies.{}.poster'.format(title.replace(" ", "_")),
-                          movie_posterurl)
-                    r.expire('movies.{}.poster'.format(title.replace(" ", "_")
-                                                       ), 60 * 60 * 24 * 90)
+                    movie_posterurl = tmdb_base_url() + "w342" + movie.poster_path
                 movie_overview = movie.overview
 
-                for genre in movie.genres:
-                    if genres_list is None:
-                        genres_list = "{}".format(genre.name)
-                    else:
-                        genres_list += "|{}".format(genre.name)
-                movie_genres = genres_list
-                r.set('movies.{}.title'.format(title.replace(" ", "_")
-                                               ), movie.title)
-                r.expire('movies.{}.title'.format(title.replace(" ", "_")
-                                                  ), 60 * 60 * 24 * 90)
-                r.set('movies.{}.runtime'.format(title.replace(" ", "_")
-                                                 ), movie.runtime)
-                r.expire('movies.{}.runtime'.format(title.replace(" ", "_")
-                                                    ), 60 * 60 * 24 * 90)
-                r.set('movies.{}.overview'.format(title.replace(" ", "_")
-                                                  ), movie.overview)
-                r.expire('movies.{}.overview'.format(title.replace(" ", "_")
-                                                     ), 60 * 60 * 24 * 90)
-                if movie_genres is not None:
-                    r.set('movies.{}.genres'.format(title.replace(" ", "_")
-                                                    ), movie_genres)
-                    r.expire('movies.{}.genres'.format(title.replace(" ", "_")
-                                                       ), 60 * 60 * 24 * 90)
+                movie_genres = "|".join(genre.name for genre in movie.genres) or None
+                cache_store(key, {
+                    'title': movie_title,
+                    'runtime': movie_runtime or '',
+                    'poster': movie_posterurl or '',
+                    'overview': movie_overview or '',
+                    'genres': movie_genres or '',
+                })
             elif len(matches) > 1:
-                r.set('movies.{}.title'.format(title.replace(" ", "_")
-                                               ), "Multiples")
-                r.expire('movies.{}.title'.format(title.replace(" ", "_")
-                                                  ), 60 * 60 * 24 * 90)
+                cache_store(key, {'title': "Multiples"})
                 return
             else:
-                r.set('movies.{}.title'.format(title.replace(" ", "_")
-                                               ), "NotFound")
-                r.expire('movies.{}.title'.format(title.replace(" ", "_")
-                                                  ), 60 * 60 * 24 * 90)
+                cache_store(key, {'title': "NotFound"})
                 return
 
         if movie_title is None:
@@ -307,71 +331,47 @@ class Movies(BaseProcessor):
             return
 
         if movie_posterurl:
-            exists = False
-            title_clean = re.sub(r'[^a-zA-Z0-9_.\s]+', '', title.strip())
-            if not os.path.exists(os.path.join(output_folder, "Artwork",
-                                  "Movies", title_clean)):
-                os.makedirs(os.path.join(output_folder, "Artwork", "Movies",
-                            title_clean))
-            if os.path.exists(os.path.join(output_folder, "Artwork", "Movies",
-                              title_clean, "poster.jpg")):
-                exists = True
-
-            if not exists:
-                log.info('Movies: Adding poster to download list for %s', title)
-                createNewDownloadThread(movie_posterurl,
-                                        os.path.join(output_folder, "Artwork",
-                                                     "Movies", title_clean,
-                                                     "poster.jpg"))
-
-            log.info('Movies: Adding poster location for %s', title)
-            poster = ElementTree.SubElement(programme, 'icon')
-            poster.set('src', str(os.path.join(output_folder, "Artwork",
-                                               "Movies", title_clean,
-                                               "poster.jpg")))
+            fetch_poster("Movies", title, movie_posterurl)
+        return movie_runtime, movie_posterurl, movie_overview, movie_genres
+
+    def __call__(self, programme, kids):
+        found = self.found(programme)
+        if found is None:
+            return
+        title = kids['title'].text
+        movie_runtime, movie_posterurl, movie_overview, movie_genres = found
+
+        if movie_posterurl:
+            add_poster(programme, "Movies", title, movie_posterurl)
 
+        existing_cats = {c.text for c in programme.findall('category')}
         if movie_genres:
             for c in movie_genres.split("|"):
-                exists = False
-                if not programme.findall('category') == []:
-                    for old_cat in programme.findall('category'):
-                        if old_cat.text == c:
-                            exists = True
-                        if not exists:
-                            log.info('Movies: Adding category "%s"', c)
-                            category = ElementTree.SubElement(programme, 'category')
-                            category.text = c
-                else:
+                if c not in existing_cats:
                     log.info('Movies: Adding category "%s"', c)
-                    category = ElementTree.SubElement(programme, 'category')
-                    category.set('lang', 'en')
+                    category = ElementTree.SubElement(programme, 'category', lang='en')
                     category.text = c
+                    existing_cats.add(c)
 
         log.info('Movies: Adding info from TMDB for %s', title)
-        exists = False
-        for old_cat in programme.findall('category'):
-            if old_cat.text == 'movie':
-                exists = True
-        if not exists:
+        if 'movie' not in existing_cats:
             log.info('Movies: Adding category "%s"', 'Movie')
-            category = ElementTree.SubElement(programme, 'category')
-            category.set('lang', 'en')
+            category = ElementTree.SubElement(programme, 'category', lang='en')
             category.text = 'movie'
 
         if movie_overview:
             log.info('Movies: Adding overview "%s"', movie_overview)
-            if programme.find('desc') is not None:
-                programme.find('desc').text = movie_overview
-            else:
-                desc = ElementTree.SubElement(programme, 'desc')
-                desc.text = movie.overview
+            desc = kids.get('desc')
+            if desc is None:
+                desc = kids['desc'] = ElementTree.SubElement(programme, 'desc')
+            desc.text = movie_overview
 
         if movie_runtime:
             log.info('Movies: Adding runtime "%s"', movie_runtime)
-            if programme.find('length') is not None:
-                programme.remove(programme.find('length'))
-            length = ElementTree.SubElement(programme, 'length')
-            length.set('units', 'minutes')
+            length = kids.get('length')
+            if length is not None:
+                programme.remove(length)
+            length = kids['length'] = ElementTree.SubElement(programme, 'length', units='minutes')
             length.text = str(movie_runtime)
 
 
@@ -379,6 +379,7 @@ class Series(BaseProcessor):
     """
         Augment TV shows  with data from thetvdb.com
         """
+    threaded = True
 
     def __init__(self):
         if not tmdbcheck:
@@ -396,7 +397,7 @@ class Series(BaseProcessor):
         tmdb.api_key = TMDB_API
         tmdb.language = 'en'
 
-    def __call__(self, programme):
+    def lookup(self, programme):
         if not self.valid:
             return
 
@@ -413,15 +414,7 @@ class Series(BaseProcessor):
             return
         if stop is None:
             return
-        # Unfortunately strptime can't handle numeric timezones so we strip it.
-        # It's only for getting possible movies so won't matter too much.
-        if ' ' in start:
-            start = start.split(' ')[0]
-        if ' ' in stop:
-            stop = stop.split(' ')[0]
-        start_time = time.mktime(time.strptime(start, TIME_FORMAT))
-        stop_time = time.mktime(time.strptime(stop, TIME_FORMAT))
-        duration = stop_time - start_time
+        duration = programme_duration(start, stop)
 
         if duration > 5400:
             log.debug('Series: Skipping "%s" since runtime over 90 minutes',
@@ -429,18 +422,17 @@ class Series(BaseProcessor):
             return
 
         series_poster = None
-        if r.get('series.{}.title'.format(title.replace(" ", "_"))):
-            if r.get('series.{}.title'.format(title.replace(" ", "_"))
-                     ) == "NotFound":
+        key = 'series:' + title.replace(" ", "_")
+        cached = cache_fetch(key)
+
+        if cached:
+            if cached.get('title') == "NotFound":
                 log.debug('Series: Series ignore for "%s"', title)
                 return
             else:
                 log.debug('Series: Cache hit for "%s"', title)
-                if r.get('series.{}.poster'.format(title.replace(" ", "_"))
-                         ) is not None:
-                    series_poster = r.get('series.{}.poster'
-                                          .format(title.replace(" ", "_"))
-                                          ).decode('utf-8')
+                if cached.get('poster'):
+                    series_poster = cached['poster']
                     log.info('Series: Adding info from cache for %s', title)
                 else:
                     log.debug('Series: Series ignored no poster for "%s"',
@@ -448,20 +440,22 @@ class Series(BaseProcessor):
                     return
         else:
             try:
-                tvtmdb = tmdbv3api.TV()
-                results = tvtmdb.search(title.replace('?', ''))
-                log.debug('Series: Searching for title %s', title.replace('?', ''))
+                query = title.replace('?', '')
+                results = search_tv(query)
+                log.debug('Series: Searching for title %s', query)
             except tmdbv3api.tmdb.TMDbException:
                 log.exception('Series: TMDB problem searching')
                 return
             matches = []
+            norm_title = normalise_title(title)
             for result in results:
                 if result is not None:
-                    if normalise_title(title) == normalise_title(result.name):
+                    if norm_title == normalise_title(result.name):
                         matches.append(result)
             log.debug('Series: Exact title matches: %d', len(matches))
-            for series in matches:
-                log.debug('Series: Found match "%s"', series.name)
+            if log.isEnabledFor(logging.DEBUG):
+                for series in matches:
+                    log.debug('Series: Found match "%s"', series.name)
             if len(matches) >= 1:
                 try:
                     log.debug('Series: Cache miss for "%s"', title)
@@ -470,53 +464,32 @@ class Series(BaseProcessor):
                     log.exception('Series: TMDB problem fetching info')
                     return
                 log.debug('Series: Cache miss for "%s"', title)
-                tmdbconfiguration = tmdbv3api.Configuration()
-                base_url = tmdbconfiguration.info().images['base_url']
                 if seriesdetails.poster_path is not None:
-                    series_poster = base_url + "w342" + seriesdetails.poster_path
+                    series_poster = tmdb_base_url() + "w342" + seriesdetails.poster_path
                 if series_poster is not None:
-                    r.set('series.{}.title'.format(title.replace(" ", "_")),
-                          title)
-                    r.expire('series.{}.title'.format(title.replace(" ", "_")
-                                                      ), 60 * 60 * 24 * 90)
-                    series_poster = series_poster
-                    r.set('series.{}.poster'.format(title.replace(" ", "_")
-                                                    ), series_poster)
-                    r.expire('series.{}.poster'.format(title.replace(" ", "_")
-                                                       ), 60 * 60 * 24 * 90)
+                    cache_store(key, {'title': title, 'poster': series_poster})
                     log.info('Series: Adding info from TVDB for %s', title)
                 else:
                     log.debug('Series: No poster found "%s"', title)
-                    r.set('series.{}.title'.format(title.replace(" ", "_")
-                                                   ), "NotFound")
-                    r.expire('series.{}.title'.format(title.replace(" ", "_")
-                                                      ), 60 * 60 * 24 * 90)
+                    cache_store(key, {'title': "NotFound"})
                     return
 
-        exists = False
+        if series_poster is not None:
+            fetch_poster("Series", title, series_poster)
+        return series_poster
+
+    def __call__(self, programme, kids):
+        series_poster = self.found(programme)
         # Store the icon for the episode if there is one
         if series_poster is not None:
-            exists = False
-            title_clean = re.sub(r'[^a-zA-Z0-9_.\s]+', '', title.strip())
-            if not os.path.exists(os.path.join(output_folder, "Artwork", "Series", title_clean)):
-                os.makedirs(os.path.join(output_folder, "Artwork", "Series", title_clean))
-            if os.path.exists(os.path.join(output_folder, "Artwork", "Series", title_clean, "poster.jpg")):
-                exists = True
-            if not exists:
-                log.info('Series:Adding poster to download list for show "%s"',
-                         title_clean)
-                createNewDownloadThread(series_poster,
-                                        os.path.join(output_folder, "Artwork", "Series", title_clean, "poster.jpg"))
-
-            log.info('Series: Adding poster location for show "%s"', title_clean)
-            poster = ElementTree.SubElement(programme, 'icon')
-            poster.set('src', str(os.path.join(output_folder, "Artwork", "Series", title_clean, "poster.jpg")))
+            add_poster(programme, "Series", kids['title'].text, series_poster)
 
 
 class Episodes(BaseProcessor):
     """
     Augment TV shows  with data from thetvdb.com
     """
+    threaded = True
 
     def __init__(self):
         self.cache = {}
@@ -535,7 +508,7 @@ class Episodes(BaseProcessor):
         tmdb.api_key = TMDB_API
         tmdb.language = 'en'
 
-    def __call__(self, programme):
+    def lookup(self, programme):
         if not self.valid:
             return
 
@@ -549,19 +522,14 @@ class Episodes(BaseProcessor):
             return
         if stop is None:
             return
-        # Unfortunately strptime can't handle numeric timezones so we strip it.
-        # It's only for getting possible tv shows so won't matter too much.
-        if ' ' in start:
-            start = start.split(' ')[0]
-        if ' ' in stop:
-            stop = stop.split(' ')[0]
-        start_time = time.mktime(time.strptime(start, TIME_FORMAT))
-        stop_time = time.mktime(time.strptime(stop, TIME_FORMAT))
-        duration = stop_time - start_time
+        duration = programme_duration(start, stop)
         if duration > 5400:  # give up if longer than 90 minutes
             return
+        query = title.replace('?', '')
+        norm_title = normalise_title(title)
 
         try:
+            numbers = []
             for episode in episodes:
                 # TODO: is TVDB data really useless without episode numbers?
                 # There's a good chance we can find some details without...
@@ -569,201 +537,378 @@ class Episodes(BaseProcessor):
                     # log.debug('Episodes: episode "%s"', episode.text)
                     season = int(episode.text.split('.')[0]) + 1
                     episode = int(episode.text.split('.')[1]) + 1
+                    numbers.append((season, episode))
+            if not numbers:
+                return
 
-                    log.debug('Episodes: Looking up season %s, episode %s '
-                              ' of show "%s" at TVDB', season, episode, title)
-                    # get data from TMDB
-                    try:
-                        tvtmdb = tmdbv3api.TV()
-                        results = tvtmdb.search(title.replace('?', ''))
-                    except tmdbv3api.tmdb.TMDbException:
-                        log.exception('Episodes: TMDB problem searching')
-                        return
-                    matches = []
-                    for result in results:
-                        if result is not None:
-                            if normalise_title(title) == normalise_title(result.name):
-                                matches.append(result)
-                    log.debug('Series: Exact title matches: %d', len(matches))
-                    for series in matches:
-                        log.debug('Series: Found match "%s" (%s)', series.name)
-                    if len(matches) >= 1:
-                        try:
-                            log.debug('Series: Cache miss for "%s"', title)
-                            series_title = matches[0].id
-                        except tmdbv3api.tmdb.TMDbException:
-                            log.exception('Series: TMDB problem fetching info')
-                            return
-                        tvtmdb = tmdbv3api.TV()
-                        episodetmdb = tmdbv3api.Episode()
-                        series = tvtmdb.search(title.replace('?', ''))
-                        episodedetails = episodetmdb.details(matches[0], season, episode)
-                        episodename = episodedetails.name
-                        rating = episodedetails.vote_average
-                        genres = series_title.genres
-                        tmdbconfiguration = tmdbv3api.Configuration()
-                        base_url = tmdbconfiguration.info().images['base_url']
-                        series_poster = base_url + "w342" + matches[0].poster_path
-                        # TODO: add first aired date.
-                        # log.debug('Episodes: TVDB items are "%s"', list(tvdb_episode[title][season][episode].items()))
-
-                        # store the subtitle/episode name
-                        subtitle = ElementTree.SubElement(programme, 'sub-title')
-                        subtitle.text = episodename
-                        log.info('Episodes: Subtitle for "%s" is "%s"', title, episodename)
-
-                        # store the rating
-                        if rating is not None:
-                            log.info('Episodes: Adding rating "%s"', rating)
-                            if programme.find('star-rating') is not None:
-                                programme.remove(programme.find('star-rating'))
-                            urating = ElementTree.SubElement(programme, 'star-rating')
-                            value = ElementTree.SubElement(urating, 'value')
-                            value.text = str('%s/10' % rating)
-
-                        # store the genres
-                        log.debug('Episodes: genres "%s"', genres)
-                        if genres:
-                            # if 'categories' in movie and 'genre' in movie['categories']:
-                            for c in genres:
-                                if c:
-                                    exists = False
-                                    for old_cat in programme.findall('category'):
-                                        if old_cat.text == c:
-                                            exists = True
-                                    if not exists:
-                                        log.info('Episodes: Adding category "%s"', c)
-                                        category = ElementTree.SubElement(programme, 'category')
-                                        category.text = c
-
-                        exists = False
-                        if series_poster is not None:
-                            exists = False
-                            title_clean = re.sub(r'[^a-zA-Z0-9_.\s]+', '', title.strip())
-                            if not os.path.exists(os.path.join(output_folder, "Artwork", "Series", title_clean)):
-                                os.makedirs(os.path.join(output_folder, "Artwork", "Series", title_clean))
-                            if os.path.exists(os.path.join(output_folder, "Artwork", "Series", title_clean, "poster.jpg")):
-                                exists = True
-                            if not exists:
-                                log.info('Series:Adding poster to download list for show "%s"', title_clean)
-                                createNewDownloadThread(series_poster, os.path.join(output_folder, "Artwork", "Series", title_clean, "poster.jpg"))
-
-                            log.info('Series: Adding poster location for show "%s"', title_clean)
-                            poster = ElementTree.SubElement(programme, 'icon')
-                            poster.set('src', str(os.path.join(output_folder, "Artwork", "Series", title_clean, "poster.jpg")))
+            # get data from TMDB, the show is the same for every episode-num
+            try:
+                results = search_tv(query)
+            except tmdbv3api.tmdb.TMDbException:
+                log.exception('Episodes: TMDB problem searching')
+                return
+            matches = []
+            for result in results:
+                if result is not None:
+                    if norm_title == normalise_title(result.name):
+                        matches.append(result)
+            log.debug('Series: Exact title matches: %d', len(matches))
+            if log.isEnabledFor(logging.DEBUG):
+                for series in matches:
+                    log.debug('Series: Found match "%s"', series.name)
+            if not matches:
+                return
+
+            show = matches[0]
+            genres = [genre.name for genre in tv_details(show.id).genres]
+            series_poster = None
+            if show.poster_path is not None:
+                series_poster = tmdb_base_url() + "w342" + show.poster_path
+
+            found = []
+            for season, episode in numbers:
+                log.debug('Episodes: Looking up season %s, episode %s '
+                          ' of show "%s" at TVDB', season, episode, title)
+                episodedetails = episode_details(show.id, season, episode)
+                # TODO: add first aired date.
+                found.append((episodedetails.name, episodedetails.vote_average))
 
         except:
             log.exception('Episodes: TVDB problem searching')
             return
+        if series_poster is not None:
+            fetch_poster("Series", title, series_poster)
+        return found, genres, series_poster
+
+    def __call__(self, programme, kids):
+        found = self.found(programme)
+        if found is None:
+            return
+        title = kids['title'].text
+        episodes, genres, series_poster = found
+
+        for episodename, rating in episodes:
+            # store the subtitle/episode name, unless the guide has one
+            if kids.get('sub-title') is None:
+                subtitle = kids['sub-title'] = ElementTree.SubElement(programme, 'sub-title')
+                subtitle.text = episodename
+                log.info('Episodes: Subtitle for "%s" is "%s"', title, episodename)
+
+            # store the rating
+            if rating is not None:
+                log.info('Episodes: Adding rating "%s"', rating)
+                if kids.get('star-rating') is not None:
+                    programme.remove(kids['star-rating'])
+                urating = kids['star-rating'] = ElementTree.SubElement(programme, 'star-rating')
+                value = ElementTree.SubElement(urating, 'value')
+                value.text = str('%s/10' % rating)
+
+        # store the genres
+        log.debug('Episodes: genres "%s"', genres)
+        if genres:
+            existing_cats = {c.text for c in programme.findall('category')}
+            for c in genres:
+                if c and c not in existing_cats:
+                    log.info('Episodes: Adding category "%s"', c)
+                    category = ElementTree.SubElement(programme, 'category')
+                    category.text = c
+                    existing_cats.add(c)
+
+        if series_poster is not None:
+            add_poster(programme, "Series", title, series_poster)
 
 
 class HD(BaseProcessor):
     """
     Look for a HD note in a description.
     """
-    regexes = (
-        re.compile(r'HD\.?$'),
-        re.compile(r'\(HD\)$'),
-    )
+    regex = re.compile(r'(?:HD\.?|\(HD\))$')
 
-    def __call__(self, programme):
-        desc = programme.find('desc')
+    def __call__(self, programme, kids):
+        desc = kids.get('desc')
         if desc is not None and desc.text:
-            for regex in self.regexes:
-                matched = regex.search(desc.text)
-                if matched:
-                    log.debug('HD: Found "%s"', programme.find('title').text)
-                    if programme.find('video') is not None:
-                        if programme.find('quality') is None:
-                            quality = ElementTree.SubElement(programme.find('video'), 'quality')
-                            quality.text = 'HDTV'
-                        elif programme.find('quality').text != 'HDTV':
-                            programme.find('quality').text = 'HDTV'
-                    else:
-                        video = ElementTree.SubElement(programme, 'video')
-                        present = ElementTree.SubElement(video, 'present')
-                        present.text = 'yes'
-                        aspect = ElementTree.SubElement(video, 'aspect')
-                        aspect.text = '16:9'
+            matched = self.regex.search(desc.text)
+            if matched:
+                log.debug('HD: Found "%s"', kids['title'].text)
+                video = kids.get('video')
+                if video is not None:
+                    quality = video.find('quality')
+                    if quality is None:
                         quality = ElementTree.SubElement(video, 'quality')
                         quality.text = 'HDTV'
-                    desc.text = regex.sub('', desc.text)
+                    elif quality.text != 'HDTV':
+                        quality.text = 'HDTV'
+                else:
+                    video = kids['video'] = ElementTree.SubElement(programme, 'video')
+                    present = ElementTree.SubElement(video, 'present')
+                    present.text = 'yes'
+                    aspect = ElementTree.SubElement(video, 'aspect')
+                    aspect.text = '16:9'
+                    quality = ElementTree.SubElement(video, 'quality')
+                    quality.text = 'HDTV'
+                desc.text = desc.text[:matched.start()]
 
 
 class Subtitle(BaseProcessor):
     """
     Look for a subtitle in a description.
     """
-    regexes = (
-        re.compile(r"(Today|Tonight)?:? ?'(?P<subtitle>.*?)'\.\s?"),
-        re.compile(r"'(?P<subtitle>.{2,60}?)\.'\s"),
-        re.compile(r"(?P<subtitle>.{2,60}?):\s"),
+    # alternatives are tried in order, each captures into its own group
+    regex = re.compile(
+        r"(?:Today|Tonight)?:? ?'(?P<quoted>.*?)'\.\s?"
+        r"|'(?P<quoted_stop>.{2,60}?)\.'\s"
+        r"|(?P<colon>.{2,60}?):\s"
     )
 
-    def __call__(self, programme):
-        desc = programme.find('desc')
+    def __call__(self, programme, kids):
+        desc = kids.get('desc')
         if desc is not None and desc.text:
-            for regex in self.regexes:
-                matched = regex.match(desc.text)
-                if matched and 'subtitle' not in programme:
-                    subtitle = ElementTree.SubElement(programme, 'sub-title')
-                    subtitle.text = matched.group('subtitle')
-                    log.debug('Subtitle: "%s" for "%s"', subtitle.text, programme.find('title').text)
-                    desc.text = regex.sub('', desc.text)
+            matched = self.regex.match(desc.text)
+            if matched:
+                subtitle = kids['sub-title'] = ElementTree.SubElement(programme, 'sub-title')
+                subtitle.text = matched.group(matched.lastgroup)
+                log.debug('Subtitle: "%s" for "%s"', subtitle.text, kids['title'].text)
+                desc.text = desc.text[matched.end():]
 
 
 class EpDesc(BaseProcessor):
     """
     Look for a Season/Episode info in a description.
     """
-    desc_regexes = (
-        re.compile(r' S\s?(\d+) Ep\s?(\d+)'),
-    )
-    progid_regexes = (
-        re.compile(r'\s?(\d+)Ep\s?(\d+)'),
-    )
+    # one pattern per source, add formats as alternatives with named groups
+    desc_regex = re.compile(r' S\s?(?P<season>\d+) Ep\s?(?P<episode>\d+)')
+    progid_regex = re.compile(r'\s?(?P<season>\d+)Ep\s?(?P<episode>\d+)')
 
-    def __call__(self, programme):
-        desc = programme.find('desc')
+    def __call__(self, programme, kids):
+        episodes = programme.findall('episode-num')
+        # the guide already has the episode number, skip the regex scans
+        if any(episode.get('system') == 'xmltv_ns' for episode in episodes):
+            return
+        title = kids['title'].text
+        desc = kids.get('desc')
         if desc is not None and desc.text:
-            for regex in self.desc_regexes:
-                matched = regex.search(desc.text)
-                if matched:
-                    season, episode = [int(x) for x in matched.groups()]
-                    log.debug('EpDesc: From desc: Found season %s episode %s for "%s"', season, episode, programme.find('title').text)
-                    episode_num = ElementTree.SubElement(programme, 'episode-num')
-                    episode_num.set('system', 'xmltv_ns')
-                    episode_num.text = '%s.%s.0' % (season - 1, episode - 1)
+            matched = self.desc_regex.search(desc.text)
+            if matched:
+                season, episode = matched.group('season', 'episode')
+                log.debug('EpDesc: From desc: Found season %s episode %s for "%s"', season, episode, title)
+                episode_num = ElementTree.SubElement(programme, 'episode-num', system='xmltv_ns')
+                episode_num.text = f'{int(season) - 1}.{int(episode) - 1}.0'
         # choice tv puts the season number in the guide data. lets get it!
         # TODO: they use the same format for movies. shouldn't insert those.
-        episodes = programme.findall('episode-num')
         for episode in episodes:
             if episode.get('system') == "dd_progid":
-                for regex in self.progid_regexes:
-                    matched = regex.search(episode.text)
-                    if matched:
-                        season, ep = [int(x) for x in matched.groups()]
-                        log.debug('EpDesc: episode "%s"', episode.text)
-                        log.debug('EpDesc: From dd_progid: Found season %s episode %s for "%s"', season, ep, programme.find('title').text)
-                        episode_num = ElementTree.SubElement(programme, 'episode-num')
-                        episode_num.set('system', 'xmltv_ns')
-                        episode_num.text = '%s.%s.0' % (season - 1, ep - 1)
-
-
-def compare_programme(x):
-    """
-       Comparison helper to sort the children elements of an
-       XMLTV programme tag.
-    """
-    programme_order = (
-        'title', 'sub-title', 'desc', 'credits', 'date',
-        'category', 'language', 'orig-language', 'length',
-        'icon', 'url', 'country', 'episode-num', 'video', 'audio',
-        'previously-shown', 'premiere', 'last-chance', 'new',
-        'subtitles', 'rating', 'star-rating',
-    )
-    # TODO: don't know if the fillowing line errors when not found or returns 0
-    return programme_order.index(x.tag)
+                matched = self.progid_regex.search(episode.text)
+                if matched:
+                    season, ep = matched.group('season', 'episode')
+                    log.debug('EpDesc: episode "%s"', episode.text)
+                    log.debug('EpDesc: From dd_progid: Found season %s episode %s for "%s"', season, ep, title)
+                    episode_num = ElementTree.SubElement(programme, 'episode-num', system='xmltv_ns')
+                    episode_num.text = f'{int(season) - 1}.{int(ep) - 1}.0'
+
+
+def preload_cache():
+    """
+    Load every cached movie and series hash from Redis in one pipeline, so
+    titles seen on earlier runs need no round-trip per programme.
+    """
+    global redis_preloaded
+    keys = []
+    pipe = r.pipeline(transaction=False)
+    for pattern in ('movies:*', 'series:*'):
+        for key in r.scan_iter(match=pattern, count=1000):
+            keys.append(key)
+            pipe.hgetall(key)
+    redis_cache.update(zip(keys, pipe.execute()))
+    redis_preloaded = True
+    log.debug('Preloaded %d cached titles from Redis', len(keys))
+
+
+def cache_fetch(key):
+    """
+    A title's cached details, from the preloaded copy if we have it. Once
+    the preload worked that copy has everything, so a miss means nothing
+    is cached and Redis is only asked when the preload failed.
+    """
+    cached = redis_cache.get(key)
+    if cached is None and not redis_preloaded:
+        cached = r.hgetall(key)
+        if cached:
+            redis_cache[key] = cached
+    return cached
+
+
+def cache_store(key, fields):
+    """
+    Store a title's details as a Redis hash and (re)set its expiry, in one
+    round-trip. Lookups for the same title running at once all find the
+    same details, so only the first one writes them.
+    """
+    with stored_lock:
+        if key in stored_keys:
+            return
+        stored_keys.add(key)
+    pipe = r.pipeline(transaction=False)
+    pipe.hset(key, mapping=fields)
+    pipe.expire(key, REDIS_EXPIRE)
+    pipe.execute()
+    redis_cache[key] = {field: str(value) for field, value in fields.items()}
+
+
+def memoise(func):
+    """
+    Keep a function's results for the rest of the run. Threads asking for
+    the same arguments at once wait for the first call rather than
+    repeating it. Failures aren't kept, the next call tries again.
+    """
+    results = {}
+    lock = threading.Lock()
+
+    @wraps(func)
+    def wrapper(*args):
+        with lock:
+            future = results.get(args)
+            first = future is None
+            if first:
+                future = results[args] = Future()
+        if first:
+            try:
+                future.set_result(func(*args))
+            except BaseException as e:
+                with lock:
+                    del results[args]
+                future.set_exception(e)
+        return future.result()
+    return wrapper
+
+
+@memoise
+def search_movies(query):
+    """
+    Search TMDB for movies. Programmes repeat a lot so results are kept
+    for the rest of the run.
+    """
+    return tuple(tmdbv3api.Movie().search(query))
+
+
+@memoise
+def search_tv(query):
+    """
+    Search TMDB for TV shows. Programmes repeat a lot so results are kept
+    for the rest of the run.
+    """
+    return tuple(tmdbv3api.TV().search(query))
+
+
+@memoise
+def movie_details(movie_id):
+    """
+    Fetch a movie from TMDB, kept for the rest of the run.
+    """
+    return tmdbv3api.Movie().details(movie_id)
+
+
+@memoise
+def tv_details(tv_id):
+    """
+    Fetch a TV show from TMDB, kept for the rest of the run.
+    """
+    return tmdbv3api.TV().details(tv_id)
+
+
+@memoise
+def episode_details(tv_id, season, episode):
+    """
+    Fetch an episode from TMDB, kept for the rest of the run.
+    """
+    return tmdbv3api.Episode().details(tv_id, season, episode)
+
+
+def tmdb_base_url():
+    """
+    Base URL for TMDB images. This practically never changes so it is only
+    fetched from TMDB once per run.
+    """
+    global tmdb_images_url
+    if tmdb_images_url is None:
+        with tmdb_images_lock:
+            # another lookup thread may have fetched it while we waited
+            if tmdb_images_url is None:
+                tmdb_images_url = tmdbv3api.Configuration().info().images['base_url']
+    return tmdb_images_url
+
+
+def children(programme):
+    """
+    Map each child tag of a programme to its first element with that tag,
+    so several lookups cost one pass over the children instead of one
+    find() each.
+    """
+    return {child.tag: child for child in reversed(programme)}
+
+
+PROGRAMME_ORDER = {tag: i for i, tag in enumerate((
+    'title', 'sub-title', 'desc', 'credits', 'date',
+    'category', 'language', 'orig-language', 'length',
+    'icon', 'url', 'country', 'episode-num', 'video', 'audio',
+    'previously-shown', 'premiere', 'last-chance', 'new',
+    'subtitles', 'rating', 'star-rating',
+))}
+
+
+def sort_programme(programme):
+    """
+       Sort the children elements of an XMLTV programme tag.
+       Tags we don't know about go last, in their original order.
+    """
+    last = len(PROGRAMME_ORDER)
+    # (order, position, child) tuples sort on plain ints, never
+    # reaching the element itself since the positions are unique
+    ordered = [(PROGRAMME_ORDER.get(child.tag, last), i, child)
+               for i, child in enumerate(programme)]
+    ordered.sort()
+    programme[:] = [child for _, _, child in ordered]
+
+
+def parse_time(value):
+    """
+    Turn the YYYYMMDDhhmmss part of an XMLTV time into a datetime.
+    """
+    return datetime(int(value[0:4]), int(value[4:6]), int(value[6:8]),
+                    int(value[8:10]), int(value[10:12]), int(value[12:14]))
+
+
+def programme_duration(start, stop):
+    """
+    Length of a programme in seconds.
+
+    Any timezone offset is ignored. It's only for guessing what kind of
+    programme this is so won't matter too much.
+    """
+    return (parse_time(stop) - parse_time(start)).total_seconds()
+
+
+class KeepTable(dict):
+    """
+    str.translate table that deletes every character keep() rejects. Each
+    character is only classified the first time it is seen.
+    """
+
+    def __init__(self, keep):
+        dict.__init__(self)
+        self.keep = keep
+
+    def __missing__(self, key):
+        value = key if self.keep(chr(key)) else None
+        self[key] = value
+        return value
+
+
+# ASCII letters and digits, '_', '.' and whitespace, for folder names
+clean_table = KeepTable(
+    lambda char: (char.isascii() and (char.isalnum() or char in '_.'))
+    or char.isspace())
+NON_ALPHA_RE = re.compile('[^a-z ]')
+MULTISPACE_RE = re.compile(' +')
 
 
 def normalise_title(title):
@@ -773,51 +918,136 @@ def normalise_title(title):
     normalised = title.lower()
     if normalised.startswith('the '):
         normalised = normalised[4:]
-    normalised = re.sub('[^a-z ]', '', normalised)
-    normalised = re.sub(' +', ' ', normalised)
+    normalised = NON_ALPHA_RE.sub('', normalised)
+    normalised = MULTISPACE_RE.sub(' ', normalised)
     normalised = normalised.replace(' the ', ' ')
     return normalised
 
 
+def clean_title(title):
+    """
+    Strip a title down to something usable as a folder name.
+    """
+    return title.strip().translate(clean_table)
+
+
 def indent(elem, level=0):
     """
-    Make ElementTree output pretty.
-    """
-    i = "\n" + level * "\t"
-    if len(elem):
-        if not elem.text or not elem.text.strip():
-            elem.text = i + "\t"
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-        for elem in elem:
-            indent(elem, level + 1)
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-    else:
-        if level and (not elem.tail or not elem.tail.strip()):
-            elem.tail = i
+    Make ElementTree output pretty, indenting with tabs whichever backend
+    is in use.
+    """
+    if hasattr(ElementTree, 'indent'):
+        # Python 3.9+, lxml 4.5+
+        ElementTree.indent(elem, space="\t", level=level)
+        return
+
+    def blank(text):
+        return not text or not text.strip()
+
+    if (len(elem) or level) and blank(elem.tail):
+        elem.tail = "\n" + level * "\t"
+    # walk the tree with a stack rather than recursing, building the
+    # whitespace once per parent rather than once per element
+    stack = [(elem, level)]
+    while stack:
+        parent, depth = stack.pop()
+        if not len(parent):
+            continue
+        outer = "\n" + depth * "\t"
+        inner = outer + "\t"
+        if blank(parent.text):
+            parent.text = inner
+        for child in parent:
+            if blank(child.tail):
+                child.tail = inner
+            stack.append((child, depth + 1))
+        if blank(child.tail):
+            child.tail = outer
+
+
+def make_dirs(path):
+    """
+    Create a directory and any missing parents, once per run.
+    """
+    if path not in dirs_made:
+        Path(path).mkdir(parents=True, exist_ok=True)
+        dirs_made.add(path)
+
+
+def fetch_poster(kind, title, url):
+    """
+    Local path of the poster for a title, queueing the download the first
+    time we see a poster we don't have yet. Safe to call from lookups, so
+    downloads can start while other lookups are still running.
+    """
+    title_clean = clean_title(title)
+    poster_dir = os.path.join(output_folder, "Artwork", kind, title_clean)
+    poster_file = os.path.join(poster_dir, "poster.jpg")
+    with posters_lock:
+        seen = poster_file in posters_seen
+        posters_seen.add(poster_file)
+    if not seen:
+        make_dirs(poster_dir)
+        if not os.path.exists(poster_file):
+            log.info('%s: Adding poster to download list for "%s"', kind,
+                     title_clean)
+            queue_download(url, poster_file)
+    return poster_file
+
+
+def add_poster(programme, kind, title, url):
+    """
+    Point a programme's icon at the local poster for a title.
+    """
+    poster_file = fetch_poster(kind, title, url)
+    # Series and Episodes both find the show's poster
+    for icon in programme.iterfind('icon'):
+        if icon.get('src') == poster_file:
+            return
+    log.info('%s: Adding poster location for "%s"', kind, title)
+    ElementTree.SubElement(programme, 'icon', src=poster_file)
 
 
 def download(link, filelocation):
-    if not os.path.exists(os.path.dirname(filelocation.strip())):
-        log.info('Made Directory: "%s"', os.path.dirname(filelocation.strip()))
-        os.makedirs(os.path.dirname(filelocation.strip()))
-    r = requests.get(link.replace("http://thetvdb", "http://www.thetvdb"), stream=True)
-    with open(filelocation, 'wb') as f:
-        for chunk in r.iter_content(1024):
-            if chunk:
-                f.write(chunk)
-
-
-def createNewDownloadThread(link, filelocation):
-    threads = []
-    t = threading.Thread(target=download, args=(link, filelocation))
-    threads.append(t)
-    t.start()
-    # cap the threads if over limit
-    while threading.active_count() >= threadcount:
-        threads = threading.active_count()
-        time.sleep(5)
+    make_dirs(os.path.dirname(filelocation.strip()))
+    # closing the response hands the connection back to the session's pool
+    with session.get(link.replace("http://thetvdb", "http://www.thetvdb"),
+                     stream=True, timeout=30) as response:
+        response.raise_for_status()
+        # copy the body in C, undoing any gzip/deflate transfer encoding
+        response.raw.decode_content = True
+        with open(filelocation, 'wb') as f:
+            shutil.copyfileobj(response.raw, f, 1 << 20)
+
+
+def prefetch(processors, programmes):
+    """
+    Run the processors' lookups over all programmes in a thread pool so the
+    network calls overlap. Each processor keeps its results for found(),
+    the tree itself is only ever modified from the main thread.
+    Threads rather than processes: the lookups wait on the network, and
+    elements would have to be pickled and merged back into the tree.
+    """
+    def lookup(programme):
+        for processor in processors:
+            try:
+                processor.prefetched[programme] = processor.lookup(programme)
+            except:
+                # already logged, don't try again from the main thread
+                processor.prefetched[programme] = None
+                log.exception("Failed lookup with processor: %s", processor)
+
+    for processor in processors:
+        processor.prefetched = {}
+    with ThreadPoolExecutor(max_workers=threadcount) as executor:
+        executor.map(lookup, programmes)
+
+
+def queue_download(link, filelocation):
+    """
+    Download in the background, at most threadcount at a time.
+    """
+    downloadlist.append(download_pool.submit(download, link, filelocation))
 
 
 #############################################################################
@@ -857,12 +1087,12 @@ if __name__ == '__main__':
             log.critical('No input file to process.')
             sys.exit(2)
         try:
-            data = open(args[0]).read()
+            source = open(args[0], 'rb')
         except IOError:
             log.critical('Could not open input file "%s"', args[0])
             sys.exit(2)
     else:
-        data = sys.stdin.read()
+        source = sys.stdin.buffer
 
     processors = [
         Subtitle(),                 # extract the show sub-title from the title, which is often where
@@ -873,33 +1103,56 @@ if __name__ == '__main__':
         Episodes(),                 # augment the guide data with info from TVDB
     ]
 
-    tree = ElementTree.XML(data)
-    for processor in processors:
-        for programme in tree.findall('.//programme'):
+    if lxmlcheck:
+        # match the stdlib parser, which drops comments, and drop the
+        # original whitespace so indent() can lay out the whole tree
+        xml_parser = ElementTree.XMLParser(remove_comments=True,
+                                           remove_blank_text=True)
+    else:
+        xml_parser = None
+    # let the parser read the bytes from the file itself, no copy in memory
+    with source:
+        tree = ElementTree.parse(source, xml_parser).getroot()
+    programmes = find_programmes(tree)
+    threaded = [processor for processor in processors
+                if processor.threaded and processor.valid]
+    if threaded:
+        try:
+            preload_cache()
+        except redis.exceptions.RedisError:
+            # cache_fetch() asks Redis for each title instead
+            log.exception('Could not preload the cache from Redis')
+        prefetch(threaded, programmes)
+
+    # run every processor over a programme before moving on to the next
+    for programme in programmes:
+        kids = children(programme)
+        for processor in processors:
             try:
-                processor(programme)
+                processor(programme, kids)
             except:
                 log.exception("Failed processing with processor: %s", processor)
-    try:
-        processor.post_process(tree)
-    except NotImplementedError:
-        pass
-    except:
-        log.exception("Failed post processing with processor: %s", processor)
 
-    for programme in tree.findall('.//programme'):
-        programme[:] = sorted(programme, key=compare_programme)
+    for processor in processors:
+        try:
+            processor.post_process(tree)
+        except NotImplementedError:
+            pass
+        except:
+            log.exception("Failed post processing with processor: %s", processor)
 
-    indent(tree)
+    for programme in programmes:
+        sort_programme(programme)
 
-    f = open(os.path.join(output_folder, "enhanced-xmltv.xml"), "w")
-    print('<?xml version="1.0" encoding="utf-8"?>', file=f)
-    print((ElementTree.tostring(tree, encoding='unicode', method='xml')), file=f)
-    f.close()
-
-    # monitor for threads winding down
-    while threading.active_count() != 1:
-        threads = threading.active_count()
-        string = "Active download threads running - " + str(threads)
-        logging.debug(string)
-        time.sleep(5)
+    # serialise straight to the file as UTF-8 bytes
+    document = ElementTree.ElementTree(tree)
+    indent(tree)
+    with open(os.path.join(output_folder, "enhanced-xmltv.xml"), "wb") as f:
+        document.write(f, encoding='utf-8', xml_declaration=True)
+
+    # wait for the artwork downloads to finish
+    wait(downloadlist)
+    for future in downloadlist:
+        if future.exception() is not None:
+            log.error('Failed download: %s', future.exception())
+    download_pool.shutdown(wait=True)